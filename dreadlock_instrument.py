@@ -1,12 +1,19 @@
+import io
 import os
 import re
 import sys
 import glob
+import shutil
+import keyword
+import functools
 import tempfile
 import subprocess
 
 from ast import parse
+from operator import itemgetter
+from itertools import groupby, repeat
 from optparse import OptionParser
+from concurrent.futures import ProcessPoolExecutor
 
 #------------------------------------------------------------------------------
 # MIT License
@@ -32,23 +39,60 @@ from optparse import OptionParser
 # IN THE SOFTWARE.
 #------------------------------------------------------------------------------
 
+# regular expressions to identify areas of interest
+# (the lazy template argument may nest to any depth; the constructor's
+# arguments are matched separately by _call_arguments())
+_UNIQUE_LOCK_RE = re.compile(r'std::unique_lock<.+?>\s+(\w+)\(')
+# every character sequence that can change the state of the scope scanner
+_SCAN_RE = re.compile(r'\n|//|/\*|"|\'|\{|\}')
+# the remainder of a string or character literal, including its closing quote
+_STRING_BODY_RE = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_CHAR_BODY_RE = re.compile(r"[^'\\]*(?:\\.[^'\\]*)*'", re.DOTALL)
+
+def _line_comment_end(file_data, pos):
+    # stop at the newline itself so the scanner still counts it
+    return file_data.find('\n', pos)
+
+def _block_comment_end(file_data, pos):
+    end = file_data.find('*/', pos)
+    return end if end == -1 else end + 2
+
+def _string_end(file_data, pos):
+    body = _STRING_BODY_RE.match(file_data, pos)
+    return -1 if body is None else body.end()
+
+def _char_end(file_data, pos):
+    body = _CHAR_BODY_RE.match(file_data, pos)
+    return -1 if body is None else body.end()
+
+# scanner tokens that open a comment or literal, mapped to a function that
+# locates its end (-1 if it is unterminated)
+_REGION_END = {
+    '//' : _line_comment_end,
+    '/*' : _block_comment_end,
+    '"'  : _string_end,
+    "'"  : _char_end,
+}
+
 class LockInfo:
-    def __init__(self, name = "", id = "", deferred = False, source = None):
-        if source is None:
-            self.mutex_name = name
-            self.id_name = id  # !empty if mutex name is invalid as variable
-            self.is_deferred = deferred
-            self.is_locked = False if deferred else True
-            self.outer_scope = False # does this lock exist outside the current scope?
-            self.excluded = False # do not instrument this mutex instance
-        else:
-            # do copy construction
-            self.mutex_name = source.mutex_name
-            self.id_name = source.id_name
-            self.is_deferred = source.is_deferred
-            self.is_locked = source.is_locked
-            self.outer_scope = source.outer_scope
-            self.excluded = source.excluded
+    __slots__ = ('mutex_name', 'id_name', 'is_deferred', 'is_locked', 'outer_scope', 'excluded')
+
+    def __init__(self, name = "", id = "", deferred = False):
+        self.mutex_name = name
+        self.id_name = id  # !empty if mutex name is invalid as variable
+        self.is_deferred = deferred
+        self.is_locked = False if deferred else True
+        self.outer_scope = False # does this lock exist outside the current scope?
+        self.excluded = False # do not instrument this mutex instance
+
+    @classmethod
+    def clone(cls, source):
+        # copy 'source' into a nested scope, flagging its origin
+        info = cls(source.mutex_name, source.id_name, source.is_deferred)
+        info.is_locked = source.is_locked
+        info.excluded = source.excluded
+        info.outer_scope = True
+        return info
 
     def _info(self):
         return f'mutex: {self.mutex_name}, id: {self.id_name}, locked: {self.is_locked}, deferred: {self.is_deferred}, outer_scope: {self.outer_scope}, excluded: {self.excluded}'
@@ -59,129 +103,188 @@ class LockInfo:
     def __repr__(self):
         return self._info()
 
-def map_scopes(filename, lines, options):
-    if options.sanitize_input:
-        # run 'filename' through clang-format before processing
-        command = [options.clangformat, filename]
+def _decode_source(raw):
+    # decode module contents with the same newline translation a text-mode
+    # read would apply.  decoding is strict: a module that isn't UTF-8 raises
+    # here rather than being rewritten with its characters replaced.
+    file_data = raw.decode('utf-8')
+    if '\r' in file_data:
+        file_data = file_data.replace('\r\n', '\n').replace('\r', '\n')
+
+    return file_data
+
+def _mirror_module(module, temp_dir):
+    # copy 'module' to the same absolute path beneath 'temp_dir', along with
+    # every style file clang-format could consult walking up from it, so
+    # style discovery (including InheritParentConfig) matches the original
+    source = os.path.abspath(module)
+    drive, tail = os.path.splitdrive(source)
+    copy_name = os.path.join(temp_dir, drive.strip(':\\/'), tail.lstrip('\\/'))
+    os.makedirs(os.path.dirname(copy_name), exist_ok=True)
+    shutil.copyfile(module, copy_name)
+
+    folder = os.path.dirname(source)
+    copy_folder = os.path.dirname(copy_name)
+    while True:
+        for name in ('.clang-format', '_clang-format'):
+            style_file = os.path.join(folder, name)
+            if os.path.isfile(style_file) and not os.path.exists(os.path.join(copy_folder, name)):
+                shutil.copyfile(style_file, os.path.join(copy_folder, name))
+
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            break
+        folder = parent
+        copy_folder = os.path.dirname(copy_folder)
+
+    return copy_name
+
+def sanitize_modules(modules, options):
+    # run all 'modules' through a single clang-format process, rather than
+    # starting one per module.  each module is formatted as a mirrored copy
+    # in a temporary directory, so the source tree is never written to.
+    sanitized = {}
+    copies = {}
+    with tempfile.TemporaryDirectory(prefix='dreadlock_') as temp_dir:
+        for module in modules:
+            copies[module] = _mirror_module(module, temp_dir)
+
         # we let subprocess throw an unhandled exception, halting
         # execution, if 'clangformat' isn't correct
-        output = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0] #.decode("utf-8")
-
-        handle, filename = tempfile.mkstemp()
-        with os.fdopen(handle, "wb") as f:
-            f.write(output)
-
-    in_string = False
-    in_single_comment = False
-    in_multi_comment = False
-    in_escape = 0
-    last_char = ''
-    string_char = ''
-    line_no = 0
-    col_no = 0
+        subprocess.run([options.clangformat, '-i'] + list(copies.values()), check=True)
+
+        for module, copy_name in copies.items():
+            with open(copy_name, "rb") as f:
+                sanitized[module] = f.read()
+
+    return sanitized
+
+def map_scopes(filename, lines, options, formatted = None):
+    # 'formatted' is this module's clang-format output, if already available
+    if options.sanitize_input:
+        output = formatted
+        if output is None:
+            # pipe the contents of 'filename' through clang-format before
+            # processing.  '--assume-filename' lets it locate the same style
+            # files it would have found for the module itself.
+            with open(filename, 'rb') as f:
+                raw = f.read()
+            command = [options.clangformat, f'--assume-filename={filename}']
+            # we let subprocess throw an unhandled exception, halting
+            # execution, if 'clangformat' isn't correct
+            output = subprocess.run(command, input=raw, capture_output=True, check=True).stdout
+
+        # use the formatted text directly; there's no need to round-trip it
+        # through the file system
+        file_data = _decode_source(output)
+    else:
+        with open(filename, 'rb') as f:
+            file_data = _decode_source(f.read())
+
+    file_lines, scopes = map_scopes_from_text(file_data)
+    lines += file_lines
+
+    return scopes
 
-    line = []
+def map_scopes_from_text(file_data):
+    # map the scopes of already-read module text, returning the module's
+    # lines along with the scopes found on each of them
+    line_no = 0
+    line_start = 0
 
     scopes_tree = []
     scope_stack = []
 
-    file_data = ''
-    with open(filename) as f:
-        file_data = f.read()
-
-    for c in file_data:
-        if c == '\n':
+    # split the whole buffer at once; the scanner below only needs to
+    # track where each line begins
+    lines = file_data.split('\n')
+    if len(lines[-1]) == 0:
+        lines.pop()     # the file ended with a newline
+
+    # only visit the tokens that can change the scanner's state.  comments and
+    # strings are skipped over in a single search each, so their contents
+    # are never examined here.
+    pos = 0
+    while True:
+        m = _SCAN_RE.search(file_data, pos)
+        if m is None:
+            break
+
+        token = m.group()
+        ndx = m.start()
+        pos = m.end()
+
+        if token == '\n':
             line_no += 1
-            col_no = 0
+            line_start = pos
+            continue
 
-            lines.append(''.join(line))
-            line = []
-            in_single_comment = False
-        else:
-            if c == '\\':
-                if in_string:
-                    in_escape = 2 if last_char != '\\' else 0
-            elif c == '/':
-                if last_char == '/':
-                    if (not in_single_comment) and (not in_multi_comment) and (not in_string):
-                        if in_escape == 0:
-                            in_single_comment = True
-                elif last_char == '*':
-                    if in_multi_comment and (not in_string):
-                        in_multi_comment = False
-            elif c == '*':
-                if last_char == '/':
-                    if (not in_single_comment) and (not in_multi_comment) and (not in_string):
-                        in_multi_comment = True
-            elif (c == '"') or (c == "'"):
-                if (not in_single_comment) and (not in_multi_comment):
-                    if in_escape == 0:
-                        if in_string:
-                            if string_char == c:
-                                in_string = False
-                        else:
-                            string_char = c
-                            in_string = True
-            elif c == '{':
-                if (not in_single_comment) and (not in_multi_comment):
-                    if not in_string:
-                        if in_escape == 0:
-                            scope_stack.append([[line_no, col_no], [0, 0], []])
-            elif c == '}':
-                if (not in_single_comment) and (not in_multi_comment):
-                    if (not in_string) and len(scope_stack) != 0:
-                        if in_escape == 0:
-                            # roll this scope back up to its parent (if applicable)
-                            scope_token = scope_stack[-1]
-                            scope_stack = scope_stack[:-1]
-
-                            scope_token[1][0] = line_no
-                            scope_token[1][1] = col_no
-
-                            if len(scope_stack) == 0:
-                                scopes_tree.append(scope_token)
-                            else:
-                                scope_stack[-1][2].append(scope_token)
-            line.append(c)
-            col_no += 1
+        find_end = _REGION_END.get(token)
+        if find_end is None:
+            # the only remaining tokens are braces
+            if token == '{':
+                scope_stack.append([[line_no, ndx - line_start], [0, 0], []])
+            elif len(scope_stack) != 0:
+                # roll this scope back up to its parent (if applicable)
+                scope_token = scope_stack.pop()
 
-            if in_escape != 0:
-                in_escape -= 1
+                scope_token[1][0] = line_no
+                scope_token[1][1] = ndx - line_start
 
-        last_char = c
+                if len(scope_stack) == 0:
+                    scopes_tree.append(scope_token)
+                else:
+                    scope_stack[-1][2].append(scope_token)
+            continue
 
-    if len(scopes_tree) == 0:
-        return []
+        end = find_end(file_data, pos)
+        if end == -1:
+            break
 
-    # create a mirror of scopes that matches the input file line-for-line
-    max_lines = len(lines)
-    scopes = [[] for i in range(max_lines)]
+        # account for any lines spanned by the skipped comment or string
+        newlines = file_data.count('\n', pos, end)
+        if newlines != 0:
+            line_no += newlines
+            line_start = file_data.rfind('\n', pos, end) + 1
 
-    # recursively process all nested scope starts/stops, maintaining parenting
-    def process_children(child_list):
-        start_line, start_col = child_list[0]
-        end_line, end_col = child_list[1]
+        pos = end
+
+    if len(scopes_tree) == 0:
+        return lines, {}
+
+    # flatten all nested scope starts/stops into (line, start, end) events,
+    # maintaining parenting.  children are pushed in reverse so they are
+    # popped in source order.
+    events = []
+    work = list(reversed(scopes_tree))
+    while work:
+        node = work.pop()
+        start_line, start_col = node[0]
+        end_line, end_col = node[1]
         if start_line == end_line:
             # this scope starts/ends on the same line
-            scopes[start_line].append((start_col, end_col))
+            events.append((start_line, start_col, end_col))
         else:
             # a start column with a negative end indicates a scope start
-            scopes[start_line].append((start_col, -1))
+            events.append((start_line, start_col, -1))
             # an end column with a negative start indicates a scope end
-            scopes[end_line].append((-1, end_col))
+            events.append((end_line, -1, end_col))
 
-        for child in child_list[2]:
-            process_children(child)
+        work.extend(reversed(node[2]))
 
-    for scope in scopes_tree:
-        process_children(scope)
+    # the sort is stable, so events on the same line keep their tree order
+    events.sort(key=itemgetter(0))
 
-    if options.sanitize_input:
-        os.remove(filename)
+    # map each line that has scope starts/stops to them; most lines have
+    # none, and are simply absent
+    scopes = {}
+    for line_no, line_events in groupby(events, key=itemgetter(0)):
+        scopes[line_no] = [(start_col, end_col) for _, start_col, end_col in line_events]
 
-    return scopes
+    return lines, scopes
 
-def is_valid_variable_name(name):
+@functools.lru_cache(maxsize=None)
+def _parses_as_variable(name):
     try:
         parse(f'{name} = None')
     except:
@@ -189,6 +292,45 @@ def is_valid_variable_name(name):
 
     return True
 
+def is_valid_variable_name(name):
+    # plain identifiers (the common case) don't need the full parser
+    if name.isidentifier() and not keyword.iskeyword(name):
+        return True
+
+    return _parses_as_variable(name)
+
+def _call_arguments(line, start):
+    # return the top-level, comma-separated arguments of the call whose
+    # opening parenthesis ends just before 'start', or None if it isn't
+    # closed on this line
+    args = []
+    depth = 0
+    arg_start = start
+    for ndx in range(start, len(line)):
+        c = line[ndx]
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            if depth == 0:
+                args.append(line[arg_start:ndx])
+                return args
+            depth -= 1
+        elif c == ',' and depth == 0:
+            args.append(line[arg_start:ndx])
+            arg_start = ndx + 1
+
+    return None
+
+def _identifier_before(line, ndx):
+    # return the identifier that ends just before 'ndx' (ignoring whitespace),
+    # along with the index at which it starts
+    end = len(line[:ndx].rstrip())
+    start = end
+    while start > 0 and (line[start - 1].isalnum() or line[start - 1] == '_'):
+        start -= 1
+
+    return line[start:end], start
+
 def instrument(lines, scopes, options):
     # were lines changed?
     changed = False
@@ -196,13 +338,6 @@ def instrument(lines, scopes, options):
     # new lines of the file
     new_lines = []
 
-    # regular epxressions to identify areas of interest
-    unique_lock_re = r'std::unique_lock<.+>\s+(\w+)\((.+)\)'
-    lock_re = r'(\w+)\s*\.\s*lock\s*\(\s*\)'
-    unlock_re = r'(\w+)\s*\.\s*unlock\s*\(\s*\)'
-    local_include_re = r'\s*#include\s*"' # no capture
-    system_include_re = r'\s*#include\s*<' # no capture
-
     # keep track of the last local and system includes we've seen
     last_local_include = -1
     last_system_include = -1
@@ -211,11 +346,13 @@ def instrument(lines, scopes, options):
     scope_level = 0
     scope_stack = []
     indent_stack = ['']
+    # default indents for each scope level, built as levels are first entered
+    indent_cache = ['']
 
     for line_ndx, line in enumerate(lines):
 
         # adjust scopes before processing the line
-        for scope in scopes[line_ndx]:
+        for scope in scopes.get(line_ndx, ()):
             # scope on same line?
             if scope[0] != -1 and scope[1] != -1:
                 pass  # we don't currently support processing within this
@@ -226,26 +363,28 @@ def instrument(lines, scopes, options):
                 if len(scope_stack):
                     new_map = {}
                     for key in scope_stack[-1]:
-                        info = scope_stack[-1][key]
-                        # copy construct the new entry
-                        new_map[key] = LockInfo(source=info)
-                        # flag its origin
-                        new_map[key].outer_scope = True
+                        new_map[key] = LockInfo.clone(scope_stack[-1][key])
 
                     scope_stack.append(new_map)
                 else:
                     scope_stack.append({})
                 indent_stack.append('')
                 scope_level += 1
+                if scope_level == len(indent_cache):
+                    indent_cache.append(indent_cache[-1] + options.indent)
 
             # scope ends?
             elif scope[1] != -1:
                 # for any mutexes in the current scope that are currently
                 # locked, inject an explicit unlock
-                indent = options.indent * scope_level
+                indent = indent_cache[scope_level]
                 if options.align and (len(indent_stack[scope_level]) != 0):
                     indent = indent_stack[scope_level]
 
+                # injections go ahead of a trailing 'return', which stays
+                # the last line regardless of how many we insert
+                last_has_return = 'return' in new_lines[-1]
+
                 for key in scope_stack[-1]:
                     info = scope_stack[-1][key]
                     if not info.excluded:
@@ -258,7 +397,7 @@ def instrument(lines, scopes, options):
                                 else:
                                     unlock_str = f"{indent}DREADLOCK_UNLOCK({info.mutex_name});"
 
-                                if 'return' in new_lines[-1]:
+                                if last_has_return:
                                     new_lines.insert(-1, f"{unlock_str}{comment_str}")
                                 else:
                                     new_lines.append(f"{unlock_str}{comment_str}")
@@ -269,7 +408,7 @@ def instrument(lines, scopes, options):
                             else:
                                 destr_str = f"{indent}DREADLOCK_DESTRUCT({info.mutex_name});"
 
-                            if 'return' in new_lines[-1]:
+                            if last_has_return:
                                 new_lines.insert(-1, f"{destr_str}{comment_str}")
                             else:
                                 new_lines.append(f"{destr_str}{comment_str}")
@@ -277,21 +416,21 @@ def instrument(lines, scopes, options):
                             changed = True
 
                 # discard current stack
-                scope_stack = scope_stack[:-1]
-                indent_stack = indent_stack[:-1]
+                scope_stack.pop()
+                indent_stack.pop()
                 scope_level -= 1
 
-        result = re.search(local_include_re, line)
-        if result != None:
-            last_local_include = line_ndx
-
-        result = re.search(system_include_re, line)
-        if result != None:
-            last_system_include = line_ndx
+        stripped = line.lstrip()
+        if stripped.startswith('#include'):
+            include_target = stripped[8:].lstrip()
+            if include_target.startswith('"'):
+                last_local_include = line_ndx
+            elif include_target.startswith('<'):
+                last_system_include = line_ndx
 
         # capture the indent of the first line encountered within the scope
         # in case we are directed to align
-        if (len(scopes[line_ndx]) == 0) and (len(line) != 0) and (len(indent_stack[scope_level]) == 0):
+        if (line_ndx not in scopes) and (len(line) != 0) and (len(indent_stack[scope_level]) == 0):
             indent = []
             for i in range(len(line)):
                 if not line[i].isspace():
@@ -302,13 +441,12 @@ def instrument(lines, scopes, options):
         # look for and parse std::unique_lock declarations
         ndx = line.find('std::unique_lock')
         if ndx != -1:
-            result = re.search(unique_lock_re, line)
-            if result != None:
+            result = _UNIQUE_LOCK_RE.search(line)
+            args = None if result is None else _call_arguments(line, result.end())
+            if args != None:
                 lock_name = result.group(1)
-                mutex_name = result.group(2)
-                is_deferred = 'std::defer_lock' in mutex_name
-                if ',' in mutex_name:
-                    mutex_name = mutex_name.split(',')[0]
+                mutex_name = args[0]
+                is_deferred = any('std::defer_lock' in arg for arg in args[1:])
 
                 excluded = ('DREADLOCK' in line) # don't re-instrument!
                 excluded = excluded or (mutex_name in options.excludes)
@@ -324,7 +462,7 @@ def instrument(lines, scopes, options):
                     elif '.' in mutex_name:
                         items = mutex_name.split('.')
                     else:
-                        assert False, "Cannot find delimiter in mutex name '%s'" % mutex_name
+                        assert False, f"Cannot find delimiter in mutex name '{mutex_name}'"
 
                     id_name = items[-1]
 
@@ -356,59 +494,49 @@ def instrument(lines, scopes, options):
 
         # is an existing unique_lock instance being locked?
         elif '.lock()' in line:
-            result = re.search(lock_re, line)
-            if result != None:
-                lock_name = result.group(1)
-                if lock_name in scope_stack[-1]:
-                    ndx = line.find('.lock()')
-                    ndx -= len(lock_name)
-
-                    info = scope_stack[-1][lock_name]
+            lock_name, ndx = _identifier_before(line, line.find('.lock()'))
+            if lock_name in scope_stack[-1]:
+                info = scope_stack[-1][lock_name]
 
-                    if not info.excluded:
-                        info.is_locked = True
+                if not info.excluded:
+                    info.is_locked = True
 
-                        original = line[ndx:]
+                    original = line[ndx:]
 
-                        revert_str = ''
-                        if not options.disable_revert:
-                            revert_str = f" // {{{{{line[:ndx]}{original}}}}}"
+                    revert_str = ''
+                    if not options.disable_revert:
+                        revert_str = f" // {{{{{line[:ndx]}{original}}}}}"
 
-                        if len(info.id_name):
-                            line = line[:ndx] + f"DREADLOCK_LOCK_ID({info.mutex_name}, {info.id_name});{revert_str}"
-                        else:
-                            line = line[:ndx] + f"DREADLOCK_LOCK({info.mutex_name});{revert_str}"
+                    if len(info.id_name):
+                        line = line[:ndx] + f"DREADLOCK_LOCK_ID({info.mutex_name}, {info.id_name});{revert_str}"
+                    else:
+                        line = line[:ndx] + f"DREADLOCK_LOCK({info.mutex_name});{revert_str}"
 
-                        changed = True
+                    changed = True
 
             new_lines.append(line)
 
         # is an existing unique_lock instance being unlocked?
         elif '.unlock()' in line:
-            result = re.search(unlock_re, line)
-            if result != None:
-                lock_name = result.group(1)
-                if lock_name in scope_stack[-1]:
-                    ndx = line.find('.unlock()')
-                    ndx -= len(lock_name)
-
-                    info = scope_stack[-1][lock_name]
+            lock_name, ndx = _identifier_before(line, line.find('.unlock()'))
+            if lock_name in scope_stack[-1]:
+                info = scope_stack[-1][lock_name]
 
-                    if not info.excluded:
-                        info.is_locked = False
+                if not info.excluded:
+                    info.is_locked = False
 
-                        original = line[ndx:]
+                    original = line[ndx:]
 
-                        revert_str = ''
-                        if not options.disable_revert:
-                            revert_str = f" // {{{{{line[:ndx]}{original}}}}}"
+                    revert_str = ''
+                    if not options.disable_revert:
+                        revert_str = f" // {{{{{line[:ndx]}{original}}}}}"
 
-                        if len(info.id_name):
-                            line = line[:ndx] + f"DREADLOCK_UNLOCK_ID({info.mutex_name}, {info.id_name});{revert_str}"
-                        else:
-                            line = line[:ndx] + f"DREADLOCK_UNLOCK({info.mutex_name});{revert_str}"
+                    if len(info.id_name):
+                        line = line[:ndx] + f"DREADLOCK_UNLOCK_ID({info.mutex_name}, {info.id_name});{revert_str}"
+                    else:
+                        line = line[:ndx] + f"DREADLOCK_UNLOCK({info.mutex_name});{revert_str}"
 
-                        changed = True
+                    changed = True
 
             new_lines.append(line)
 
@@ -428,6 +556,13 @@ def instrument(lines, scopes, options):
 
     return new_lines, changed
 
+def instrument_module(filename, options, formatted = None):
+    # map and instrument a single module, returning the new lines and
+    # whether any changes were made
+    file_lines = []
+    scopes = map_scopes(filename, file_lines, options, formatted)
+    return instrument(file_lines, scopes, options)
+
 if __name__ == "__main__":
     print('Dreadlock Instrument -- infuse C++ modules with dread of mutex deadlocks.')
     print('by Bob Hood\n')
@@ -485,30 +620,40 @@ if __name__ == "__main__":
     for module in modules:
         assert os.path.exists(module), f"File '{module}' does not exist!"
 
-        bypass_module = False
+    # modules named by an exclusion are bypassed entirely
+    excluded_modules = set(exclude.casefold() for exclude in options.excludes)
+    included_modules = [module for module in modules if module.casefold() not in excluded_modules]
+
+    sanitized = {}
+    if options.apply and options.sanitize_input and len(included_modules) > 1:
+        sanitized = sanitize_modules(included_modules, options)
 
-        module_upper = module.casefold()
-        for exclude in options.excludes:
-            exclude_upper = exclude.casefold()
-            if module_upper == exclude_upper:
-                bypass_module = True
-                break
+    # instrumenting is CPU-bound and independent for each module, so
+    # spread multiple modules across worker processes.  results are still
+    # reported below in command-line order.
+    instrumented = {}
+    if options.apply and (not options.debug) and len(included_modules) > 1:
+        with ProcessPoolExecutor() as executor:
+            # each worker receives only its own module's formatted text
+            results = executor.map(instrument_module, included_modules, repeat(options), [sanitized.get(module) for module in included_modules])
+            instrumented = dict(zip(included_modules, results))
 
-        if bypass_module:
+    for module in modules:
+        if module not in included_modules:
             print(f"Excluding file '{module}'.")
             continue
 
         if options.apply:
-            file_lines = []
-            scopes = map_scopes(module, file_lines, options)
             if options.debug:
-                for i in range(len(scopes)):
-                    s = "{}: {}".format(i, scopes[i])
+                file_lines = []
+                scopes = map_scopes(module, file_lines, options, sanitized.get(module))
+                for i in range(len(file_lines)):
+                    s = f"{i}: {scopes.get(i, [])}"
                     s += ' ' * (20 - len(s))
-                    if len(scopes[i]):
-                        s += '!> {}'.format(file_lines[i])
+                    if i in scopes:
+                        s += f'!> {file_lines[i]}'
                     else:
-                        s += '-> {}'.format(file_lines[i])
+                        s += f'-> {file_lines[i]}'
                     print(s)
                 sys.exit(0)
 
@@ -516,58 +661,60 @@ if __name__ == "__main__":
                 print(f"Instrumenting '{module}' ...", end='')
                 sys.stdout.flush()
 
-            new_lines, changed = instrument(file_lines, scopes, options)
+            if module in instrumented:
+                new_lines, changed = instrumented[module]
+            else:
+                new_lines, changed = instrument_module(module, options, sanitized.get(module))
+
             if changed:
                 if not options.dry_run:
                     if not options.overwrite:
                         print('\n'.join(new_lines))
                     else:
-                        with open(module, 'w') as f:
-                            f.write('\n'.join(new_lines))
-
-                            # always terminate a file with a newline.
-                            # the universe will thank you...
-                            if not new_lines[-1].endswith('\n'):
-                                f.write('\n')
+                        with open(module, 'w', encoding='utf-8') as f:
+                            # stream the lines rather than building one
+                            # large string.  this also always terminates the
+                            # file with a newline; the universe will thank you...
+                            f.writelines(f"{line}\n" for line in new_lines)
 
                 print(" done.")
             else:
                 print(" file was not modified.")
 
         elif options.revert:
-            dreadlock_include_re = r'\s*#include\s*"Dreadlock\.h"' # no capture
             changed = False
             new_lines = []
             reverts_found = 0
 
-            with open(module) as f:
-                for line in f:
-                    result = re.search(dreadlock_include_re, line)
-                    if result == None:
-                        line = line.rstrip()
-                        if 'DREADLOCK' in line:
-                            dreadlock_ndx = line.find('DREADLOCK')
-
-                            if '{{' in line:
-                                changed = True
-                                reverts_found += 1
-
-                                original_start_ndx = line.find('{{')
-                                original_end_ndx = line.find('}}')
+            # read with the same UTF-8 handling used when instrumenting
+            with open(module, 'rb') as f:
+                for line in io.StringIO(_decode_source(f.read())):
+                    stripped = line.lstrip()
+                    if stripped.startswith('#include') and stripped[8:].lstrip().startswith('"Dreadlock.h"'):
+                        continue
+
+                    line = line.rstrip()
+                    if 'DREADLOCK' in line:
+                        _, sep, original = line.partition('{{')
+                        if sep:
+                            changed = True
+                            reverts_found += 1
 
-                                line = line[original_start_ndx+2:original_end_ndx]
-                                new_lines.append(line)
-                            else:
-                                pass  # we don't capture this line (it was automatically added)
+                            # the revert marker always ends the line
+                            if original.endswith('}}'):
+                                original = original[:-2]
+                            new_lines.append(original)
                         else:
-                            new_lines.append(line)
+                            pass  # we don't capture this line (it was automatically added)
+                    else:
+                        new_lines.append(line)
 
             if changed:
                 if not options.dry_run:
                     if not options.overwrite:
                         print('\n'.join(new_lines))
                     else:
-                        with open(module, 'w') as f:
+                        with open(module, 'w', encoding='utf-8') as f:
                             f.write('\n'.join(new_lines))
             else:
                 print(f"No revert markers were found in '{module}'! (Did you explicitly disable revert for this file?)")